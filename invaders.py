@@ -1,6 +1,14 @@
+import argparse
+import asyncio
+import os
 import random
+import socket
+import struct
+import threading
 import time
 from abc import ABC, abstractmethod
+from array import array
+from collections import Counter, deque, namedtuple
 
 import pygame
 
@@ -55,8 +63,23 @@ INVADER_SAUCER = ("resources/saucer.png", 'resources/saucer_explosion.png', 400)
 LASER = 'resources/laser.png'
 BOMB = 'resources/bomb.png'
 
-UP = 'U'
-DOWN = 'D'
+# Who fired a projectile, also indexes the per owner projectile data
+OWNER_GUNSHIP = 0
+OWNER_INVADER = 1
+
+# Projectile limits, the defaults give the classic one laser at a time
+MAX_PROJECTILES = 256
+MAX_PROJECTILE_CAPACITY = 0xFFFF  # Snapshots and the spectator stream count projectiles in 16 bits
+MAX_LASERS = 1
+LASER_FIRE_INTERVAL = 0  # Minimum number of cycles between shots
+
+# Images a spectator may be asked to draw, referred to by index
+SPRITES = (GUNSHIP_IMAGE_FILES[0], GUNSHIP_IMAGE_FILES[1],
+           INVADER_TYPE_1[0], INVADER_TYPE_1[1],
+           INVADER_TYPE_2[0], INVADER_TYPE_2[1],
+           INVADER_TYPE_3[0], INVADER_TYPE_3[1],
+           INVADER_SAUCER[0], INVADER_SAUCER[1])
+SPRITE_INDEX = {filename: index for index, filename in enumerate(SPRITES)}
 
 LEFT = 'L'
 RIGHT = 'R'
@@ -64,27 +87,145 @@ RIGHT = 'R'
 MAX_INVADERS_IN_ROW = 9
 LIVES_Y_POSITION = 3
 
+# Render layers, drawn in this order
+LAYER_HUD = 0
+LAYER_SPRITES = 1
+LAYER_PROJECTILES = 2
+LAYER_SAUCER = 3
+LAYER_BARRIERS = 4
+NUMBER_OF_LAYERS = 5
+
 SOUNDS = {}
+FONTS = {}
+
+# Binary game state snapshots. Bump the version whenever the layout changes.
+SNAPSHOT_MAGIC = b'PYVS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_RING_SIZE = 300
+SNAPSHOT_HEADER = struct.Struct('<4sHIIi?')  # magic, version, cycle, frame, last fired, game over
+PLAYER_STATE = struct.Struct('<bI')  # lives, score
+GUNSHIP_STATE = struct.Struct('<hh?')  # x, y, exploded
+SAUCER_STATE = struct.Struct('<?hhH?')  # present, x, y, value, exploded
+SQUADREN_STATE = struct.Struct('<cB')  # direction, number of rows
+ROW_STATE = struct.Struct('<BhB')  # index, y, number of invaders
+INVADER_STATE = struct.Struct('<Bh?')  # column, x, exploded
+BARRIERS_STATE = struct.Struct('<B')  # number of barriers
+PROJECTILES_STATE = struct.Struct('<H')  # number of projectiles
+# Projectiles fields saved in a snapshot and the array typecode each is packed as
+PROJECTILE_FIELDS = (('xs', 'd'), ('ys', 'd'), ('velocities', 'd'), ('owners', 'b'), ('alive', 'b'))
+RANDOM_STATE = struct.Struct('<i625I?d')  # version, Mersenne Twister state, gauss_next
+
+# Game session server. Every message starts with MESSAGE_HEADER, a STEP
+# carries one byte of ACTION_ flags, a STATE reply is a STATE_MESSAGE and
+# an OBSERVE request is answered with a full snapshot.
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 7878
+MSG_STEP = 1
+MSG_OBSERVE = 2
+MSG_RESET = 3
+MSG_STATE = 4
+MSG_SNAPSHOT = 5
+ACTION_LEFT = 1
+ACTION_RIGHT = 2
+ACTION_FIRE = 4
+MESSAGE_HEADER = struct.Struct('<BI')  # message type, payload length
+STATE_MESSAGE = struct.Struct('<IIb?hHH')  # cycle, score, lives, game over, gunship x, invaders, projectiles
+SESSION_STEP_BUDGET = 4  # Most steps run for one session in each batch
+SESSION_MAX_PENDING = 16  # Requests queued for a session before its socket stops being read
+SERVER_REPORT_INTERVAL = 5  # seconds
+
+# Spectator broadcast. Each frame is a FRAME_HEADER followed by either a
+# keyframe holding the whole scene or a delta against the previous frame.
+SPECTATOR_PORT = 7879
+SPECTATOR_KEYFRAME_INTERVAL = FRAME_REFRESH_RATE * 2
+SPECTATOR_MAX_BUFFER = 1 << 20  # Spectators further behind than this are dropped
+SPECTATOR_CLOSE_TIMEOUT = 0.5  # Seconds allowed for flushing all spectators on close
+FRAME_KEY = 1
+FRAME_DELTA = 2
+DELTA_SCORE = 1
+DELTA_GUNSHIP = 2
+DELTA_SAUCER = 4
+FRAME_HEADER = struct.Struct('<BII')  # frame type, frame number, body length
+SCORE_STATE = struct.Struct('<Ib')  # score, lives
+SPRITE_STATE = struct.Struct('<hhB')  # x, y, sprite
+ENTITY_STATE = struct.Struct('<HhhB')  # invader id, x, y, sprite
+PROJECTILE_STATE = struct.Struct('<IhhbB')  # projectile id, x, y, velocity, owner
+SHIFT_STATE = struct.Struct('<bb')  # dx, dy applied to every invader
+CELL_STATE = struct.Struct('<BB')  # barrier, block
+COUNT = struct.Struct('<H')
+FLAGS = struct.Struct('<B')
+INVADER_ID = struct.Struct('<H')
+PROJECTILE_ID = struct.Struct('<I')
+
+# Game states. Only PLAYING runs the frame loop, the others sleep in
+# pygame.event.wait and only redraw when the window has been exposed.
+ATTRACT = 'attract'
+PLAYING = 'playing'
+PAUSED = 'paused'
+GAME_OVER = 'game over'
+GAME_OVER_DISPLAY_TIME = 2  # seconds
+
+# Stages run by the simulation side of the frame pipeline, the overlap
+# reported by StageTimings is their time spent alongside 'render'
+SIMULATION_STAGES = ('simulate', 'broadcast', 'capture')
 
 
 class ImageCache:
 
     def __init__(self):
         self.images = {}  # Dictionary if images
+        self.names = {}  # The name each cached image is held under
 
     def get(self, filename):
         if filename in self.images:
             # Image in Cache
             return self.images[filename]
         else:
-            image = pygame.image.load(filename).convert()
+            loaded = pygame.image.load(filename)
+            # The mask needs the alpha channel that convert() drops
+            MASK_CACHE.add(filename, pygame.mask.from_surface(loaded))
+            image = loaded.convert()
             self.images[filename] = image
+            self.names[image] = filename
             return image
 
+    def make(self, name, create):
+        """ Caches an image built by create() rather than loaded from a file """
+        if name not in self.images:
+            image = create()
+            self.images[name] = image
+            self.names[image] = name
+        return self.images[name]
+
+    def name(self, image):
+        """ The name an image is cached under, or '' for uncached images """
+        return self.names.get(image, '')
+
 
 IMAGE_CACHE = ImageCache()
 
 
+class MaskCache:
+    """ Pixel masks for the narrow phase of collision detection. Each
+    mask is added by ImageCache when it loads the image, before the
+    image is converted without its alpha channel. """
+
+    def __init__(self):
+        self.masks = {}  # Dictionary of masks
+
+    def add(self, filename, mask):
+        self.masks[filename] = mask
+
+    def get(self, filename):
+        if filename not in self.masks:
+            # Loading the image builds its mask
+            IMAGE_CACHE.get(filename)
+        return self.masks[filename]
+
+
+MASK_CACHE = MaskCache()
+
+
 class Player:
 
     def __init__(self, game):
@@ -96,21 +237,26 @@ class Player:
         self.game = game
         self.scoreText = Text(FONT, 15, 'Score', WHITE, 5, 5)
         self.livesText = Text(FONT, 15, 'Lives ', WHITE, DISPLAY_WIDTH - 180, LIVES_Y_POSITION + 4)
-
-    def draw(self):
-        """ draw the game object at the
-            current x, y coordinates """
-        self.livesText.draw(self.game.display_surface)
-        if self.lives == 3:
-            self.game.display_surface.blit(self.life3.image, (self.life3.x, self.life3.y))
-        if self.lives >= 2:
-            self.game.display_surface.blit(self.life2.image, (self.life2.x, self.life2.y))
-        if self.lives >= 1:
-            self.game.display_surface.blit(self.life1.image, (self.life1.x, self.life1.y))
-
-        score_value_text = Text(FONT, 15, str(self.score), GREEN, 85, 5)
-        self.scoreText.draw(self.game.display_surface)
-        score_value_text.draw(self.game.display_surface)
+        self.score_value = None
+        self.score_value_text = None
+        # The life icons never move so their blits are built once
+        self.life_entries = [(life.image, (life.x, life.y)) for life in (self.life1, self.life2, self.life3)]
+
+    def life_blits(self):
+        """ The life icons to display for the remaining lives """
+        return self.life_entries[:max(self.lives, 0)]
+
+    def submit(self, queue):
+        queue.extend(LAYER_HUD, self.life_blits())
+
+    def draw_text(self, surface, score):
+        self.livesText.draw(surface)
+        # Only render the score again when it has changed
+        if score != self.score_value:
+            self.score_value = score
+            self.score_value_text = Text(FONT, 15, str(score), GREEN, 85, 5)
+        self.scoreText.draw(surface)
+        self.score_value_text.draw(surface)
 
     def loose_life(self):
         self.lives = self.lives - 1
@@ -121,6 +267,13 @@ class Player:
     def add_to_score(self, value):
         self.score = self.score + value
 
+    def get_state(self):
+        return PLAYER_STATE.pack(self.lives, self.score)
+
+    def set_state(self, data, offset):
+        self.lives, self.score = PLAYER_STATE.unpack_from(data, offset)
+        return offset + PLAYER_STATE.size
+
 
 class GameObject(ABC):
     pass
@@ -132,11 +285,13 @@ class DrawableGameObject(GameObject):
         self.game = game
 
     @abstractmethod
-    def draw(self):
+    def submit(self, queue):
+        """ add what the object draws to the render queue """
         pass
 
 
 class ImageGameObject(DrawableGameObject):
+    layer = LAYER_SPRITES  # Render layer the object is drawn in
 
     def __init__(self, game, filename):
         super().__init__(game)
@@ -144,6 +299,9 @@ class ImageGameObject(DrawableGameObject):
         self.image = None
         self.width = 0
         self.height = 0
+        # Shown instead of filename once the object has been hit
+        self.explosion_image = None
+        self.exploded = False
         self.load_image(filename)
 
     def load_image(self, filename):
@@ -151,23 +309,28 @@ class ImageGameObject(DrawableGameObject):
         self.width = self.image.get_width()
         self.height = self.image.get_height()
 
-    def draw(self):
-        """ draw the game object at the
+    def mask(self):
+        """ The pixel mask of the image being displayed """
+        return MASK_CACHE.get(self.explosion_image if self.exploded else self.filename)
+
+    def submit(self, queue):
+        """ add the game object to the render queue at the
             current x, y coordinates """
-        self.game.display_surface.blit(self.image, (self.x, self.y))
+        queue.submit(self.layer, self.image, (self.x, self.y))
 
 
 class Life(ImageGameObject):
     def __init__(self, game, x, y):
         super().__init__(game, 'resources/gunship.png')
-        self.image = pygame.transform.scale(self.image, (23, 23))
+        self.image = IMAGE_CACHE.make(self.filename + ' 23x23',
+                                      lambda: pygame.transform.scale(self.image, (23, 23)))
         self.x = x
         self.y = y
 
 
 class Text(object):
     def __init__(self, text_font, size, message, color, xpos, ypos):
-        self.font = pygame.font.Font(text_font, size)
+        self.font = load_font(text_font, size)
         self.surface = self.font.render(message, True, color)
         self.rect = self.surface.get_rect(topleft=(xpos, ypos))
 
@@ -197,39 +360,170 @@ class MoveableGameObject(ImageGameObject):
         return pygame.Rect(self.x, self.y, self.width, self.height)
 
 
-class Bullet(MoveableGameObject):
-
-    def __init__(self, game, filename, x, y, direction, speed):
-        super().__init__(game, filename, speed)
-        self.direction = direction
-        self.x = x
-        self.y = y
-        self.sound = load_sound_file('resources/shoot.wav')
-
-    def move(self):
-        if self.direction == UP:
-            self.move_up()
-        else:
-            self.move_down()
-
-    def move_up(self):
-        """ Move the starship up the screen """
-        self.y = self.y - self.speed
-        if self.y < LASER_AREA_TOP:
-            self.remove()
-
-    def move_down(self):
-        """ Move the starship down the screen """
-        self.y = self.y + self.speed
-        if self.y + self.height > DISPLAY_HEIGHT:
-            self.remove()
-
-    def play(self):
-        self.sound.play()
+class Projectiles:
+    """ Holds every laser and bomb in flight as parallel lists
+    (position, velocity, owner, alive) rather than one object each.
+    Live projectiles are kept packed at the front of the lists; hit
+    projectiles are only flagged as dead and are compacted away on the
+    next update. Moving and culling is still a plain Python loop over
+    the lists, nothing is vectorised; only the collision tests are
+    batched, against a per owner list of rects using pygame's
+    collidelist functions. """
 
-    @abstractmethod
-    def remove(self):
-        pass
+    def __init__(self, game, capacity=MAX_PROJECTILES):
+        if not 0 <= capacity <= MAX_PROJECTILE_CAPACITY:
+            raise ValueError('Projectile capacity must be between 0 and ' + str(MAX_PROJECTILE_CAPACITY))
+        self.game = game
+        self.capacity = capacity
+        self.count = 0
+        self.xs = [0.0] * capacity
+        self.ys = [0.0] * capacity
+        self.velocities = [0.0] * capacity
+        self.owners = [0] * capacity
+        self.alive = [0] * capacity
+        # Stable ids so spectators can follow projectiles as they are compacted
+        self.ids = [0] * capacity
+        self.next_id = 0
+        # Per owner data, indexed by OWNER_GUNSHIP / OWNER_INVADER
+        self.images = (IMAGE_CACHE.get(LASER), IMAGE_CACHE.get(BOMB))
+        self.masks = (MASK_CACHE.get(LASER), MASK_CACHE.get(BOMB))
+        self.sizes = tuple(image.get_size() for image in self.images)
+        self.owned = [0, 0]
+        # Rebuilt by update(), rects[owner][i] is the projectile in slots[owner][i]
+        self.rects = ([], [])
+        self.slots = ([], [])
+
+    def spawn(self, owner, x, y, velocity):
+        """ Adds a projectile, returns False if there is no room for it """
+        if self.count == self.capacity:
+            return False
+        index = self.count
+        self.xs[index] = x
+        self.ys[index] = y
+        self.velocities[index] = velocity
+        self.owners[index] = owner
+        self.alive[index] = 1
+        self.ids[index] = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.owned[owner] += 1
+        self.count += 1
+        return True
+
+    def update(self):
+        """ Moves every projectile, drops those that have left the
+        play area or been destroyed and rebuilds the collision rects """
+        xs, ys, velocities, owners, alive = self.xs, self.ys, self.velocities, self.owners, self.alive
+        sizes = self.sizes
+        rects = ([], [])
+        slots = ([], [])
+        owned = [0, 0]
+        live = 0
+        for index in range(self.count):
+            if not alive[index]:
+                continue
+            owner = owners[index]
+            width, height = sizes[owner]
+            y = ys[index] + velocities[index]
+            if y < LASER_AREA_TOP or y + height > DISPLAY_HEIGHT:
+                continue
+            x = xs[index]
+            if live != index:
+                xs[live] = x
+                velocities[live] = velocities[index]
+                owners[live] = owner
+                alive[live] = 1
+                self.ids[live] = self.ids[index]
+            ys[live] = y
+            rects[owner].append(pygame.Rect(x, y, width, height))
+            slots[owner].append(live)
+            owned[owner] += 1
+            live += 1
+        self.count = live
+        self.rects = rects
+        self.slots = slots
+        self.owned = owned
+
+    def hits(self, rect, owner, mask=None):
+        """ Indexes of the owner's projectiles that overlap rect. Given
+        the mask of the object at rect only projectiles that touch its
+        pixels are returned. """
+        indexes = rect.collidelistall(self.rects[owner])
+        if mask is None or not indexes:
+            return indexes
+        return [index for index in indexes if self.touches(rect, mask, owner, index)]
+
+    def first_hit(self, rect, owner, mask=None):
+        """ Index of an owner's projectile overlapping rect, and touching
+        mask when one is given, or -1 """
+        if mask is None:
+            return rect.collidelist(self.rects[owner])
+        for index in rect.collidelistall(self.rects[owner]):
+            if self.touches(rect, mask, owner, index):
+                return index
+        return -1
+
+    def touches(self, rect, mask, owner, index):
+        """ Narrow phase, only used once the rects are known to overlap """
+        other = self.rects[owner][index]
+        return mask.overlap(self.masks[owner], (other.x - rect.x, other.y - rect.y)) is not None
+
+    def kill(self, owner, index):
+        """ Destroys a projectile found by hits() or first_hit() """
+        self.alive[self.slots[owner][index]] = 0
+        # An empty rect can not collide so it stays out of later tests
+        self.rects[owner][index] = pygame.Rect(0, 0, 0, 0)
+        self.owned[owner] -= 1
+
+    def reindex(self):
+        """ Rebuilds the collision rects and counts from the lists """
+        rects = ([], [])
+        slots = ([], [])
+        owned = [0, 0]
+        for index in range(self.count):
+            if self.alive[index]:
+                owner = self.owners[index]
+                width, height = self.sizes[owner]
+                rects[owner].append(pygame.Rect(self.xs[index], self.ys[index], width, height))
+                slots[owner].append(index)
+                owned[owner] += 1
+        self.rects = rects
+        self.slots = slots
+        self.owned = owned
+
+    def get_state(self):
+        count = self.count
+        parts = [PROJECTILES_STATE.pack(count)]
+        for name, typecode in PROJECTILE_FIELDS:
+            parts.append(array(typecode, getattr(self, name)[:count]).tobytes())
+        return b''.join(parts)
+
+    def set_state(self, data, offset):
+        (count,) = PROJECTILES_STATE.unpack_from(data, offset)
+        if count > self.capacity:
+            raise ValueError('Snapshot holds more projectiles than the capacity of ' + str(self.capacity))
+        offset += PROJECTILES_STATE.size
+        for name, typecode in PROJECTILE_FIELDS:
+            restored = array(typecode)
+            end = offset + count * restored.itemsize
+            restored.frombytes(data[offset:end])
+            getattr(self, name)[:count] = restored.tolist()
+            offset = end
+        self.count = count
+        # Ids are not part of the simulation state so restored projectiles get new ones
+        for index in range(count):
+            self.ids[index] = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.reindex()
+        return offset
+
+    def blits(self):
+        """ The (surface, position) pairs for every live projectile """
+        images = self.images
+        return [(images[self.owners[index]], (self.xs[index], self.ys[index]))
+                for index in range(self.count) if self.alive[index]]
+
+    def submit(self, queue):
+        queue.extend(LAYER_PROJECTILES, self.blits())
 
 
 class TargetObject(MoveableGameObject):
@@ -239,15 +533,16 @@ class TargetObject(MoveableGameObject):
         self.exploded = False
 
     def check_for_collision(self):
-        for laser in self.game.lasers:
-            if self.rect().colliderect(laser.rect()):
-                # A laser hit the alien ship
-                self.image = pygame.image.load(self.explosion_image).convert()
-                self.exploded = True
-                self.explosion.play()
-                self.game.add_to_player(self.value)
-                if self.game.remove_laser(laser):
-                    break
+        projectiles = self.game.projectiles
+        mask = self.mask() if self.game.pixel_collisions else None
+        index = projectiles.first_hit(self.rect(), OWNER_GUNSHIP, mask)
+        if index != -1:
+            # A laser hit the alien ship
+            self.image = IMAGE_CACHE.get(self.explosion_image)
+            self.exploded = True
+            self.explosion.play()
+            self.game.add_to_player(self.value)
+            projectiles.kill(OWNER_GUNSHIP, index)
 
     def rect(self):
         """ Generates a rectangle representing the objects location
@@ -264,48 +559,45 @@ class Gunship(MoveableGameObject):
         self.y = GUNSHIP_Y_POSITION
         self.explosion_image = GUNSHIP_IMAGE_FILES[1]
         self.explosion = load_sound_file('resources/invader_explosion.wav')
+        self.laser_sound = load_sound_file('resources/shoot.wav')
         self.exploded = False
 
     def fire_laser(self):
-        laser = Laser(self.game, self.x + (self.width / 2), self.y)
-        self.game.add_laser(laser)
-        laser.play()
+        """ Returns False if there was no room for another laser """
+        if not self.game.projectiles.spawn(OWNER_GUNSHIP, self.x + (self.width / 2), self.y, -LASER_SPEED):
+            return False
+        self.laser_sound.play()
+        return True
 
     def check_for_collison(self):
-        for bomb in self.game.bombs:
-            if self.rect().colliderect(bomb.rect()):
-                # A bomb hit the gun ship
-                self.image = IMAGE_CACHE.get(self.explosion_image)
-                self.exploded = True
-                self.explosion.play()
-                self.game.bombs.remove(bomb)
-                self.game.loose_life()
+        projectiles = self.game.projectiles
+        mask = self.mask() if self.game.pixel_collisions else None
+        for index in projectiles.hits(self.rect(), OWNER_INVADER, mask):
+            # A bomb hit the gun ship
+            self.image = IMAGE_CACHE.get(self.explosion_image)
+            self.exploded = True
+            self.explosion.play()
+            projectiles.kill(OWNER_INVADER, index)
+            self.game.loose_life()
 
     def refresh(self):
         if self.exploded:
             self.exploded = False
             self.load_image(self.filename)
 
-    def __str__(self):
-        return 'Gunship(' + str(self.x) + ', ' + str(self.y) + ')'
-
-
-class Laser(Bullet):
-    def __init__(self, game, x, y):
-        super().__init__(game, LASER, x, y, UP, LASER_SPEED)
-        self.persistent = False
-
-    def remove(self):
-        self.game.lasers.remove(self)
+    def get_state(self):
+        return GUNSHIP_STATE.pack(self.x, self.y, self.exploded)
 
+    def set_state(self, data, offset):
+        self.x, self.y, self.exploded = GUNSHIP_STATE.unpack_from(data, offset)
+        if self.exploded:
+            self.image = IMAGE_CACHE.get(self.explosion_image)
+        else:
+            self.load_image(self.filename)
+        return offset + GUNSHIP_STATE.size
 
-class Bomb(Bullet):
-    def __init__(self, game, x, y):
-        super().__init__(game, BOMB, x, y, DOWN, BOMB_SPEED)
-        self.sound = load_sound_file('resources/bomb.wav')
-
-    def remove(self):
-        self.game.bombs.remove(self)
+    def __str__(self):
+        return 'Gunship(' + str(self.x) + ', ' + str(self.y) + ')'
 
 
 class Invader(TargetObject):
@@ -320,11 +612,18 @@ class Invader(TargetObject):
         self.column = column
         self.exploded = False
         self.explosion = load_sound_file('resources/invader_explosion.wav')
+        self.bomb_sound = load_sound_file('resources/bomb.wav')
 
     def drop_bomb(self):
-        bomb = Bomb(self.game, self.x + (self.width / 2), self.row.y)
-        self.game.add_bomb(bomb)
-        bomb.play()
+        if self.game.projectiles.spawn(OWNER_INVADER, self.x + (self.width / 2), self.row.y, BOMB_SPEED):
+            self.bomb_sound.play()
+
+    def set_exploded(self, exploded):
+        self.exploded = exploded
+        if exploded:
+            self.image = IMAGE_CACHE.get(self.explosion_image)
+        else:
+            self.image = IMAGE_CACHE.get(self.filename)
 
     def move(self):
         # Make the move
@@ -333,10 +632,8 @@ class Invader(TargetObject):
         else:
             self.move_right()
 
-    def draw(self):
-        """ draw the game object at the
-            current x, y coordinates """
-        self.game.display_surface.blit(self.image, (self.x, self.row.y))
+    def submit(self, queue):
+        queue.submit(self.layer, self.image, (self.x, self.row.y))
 
     def __str__(self):
         return 'Invader(' + str(self.x) + ', ' + str(self.row.y) + ')'
@@ -350,6 +647,8 @@ class InvaderRow:
         self.index = index
         self.type = type
         self.setup()
+        # Every invader the row started with, used to restore snapshots
+        self.formation = list(self.invaders)
         self.squadren = squadren
         self.y = INVADER_START_Y + (self.index * 45)
 
@@ -363,7 +662,7 @@ class InvaderRow:
         return len(self.invaders)
 
     def select_invader_for_bomb(self):
-        position = random.randint(0, self.get_number_of_invaders()) - 1
+        position = self.game.random.randint(0, self.get_number_of_invaders()) - 1
         self.invaders[position].drop_bomb()
 
     def move(self):
@@ -393,6 +692,25 @@ class InvaderRow:
     def direction(self):
         return self.squadren.direction
 
+    def get_state(self):
+        parts = [ROW_STATE.pack(self.index, self.y, len(self.invaders))]
+        for invader in self.invaders:
+            parts.append(INVADER_STATE.pack(invader.column, invader.x, invader.exploded))
+        return b''.join(parts)
+
+    def set_state(self, data, offset):
+        index, self.y, count = ROW_STATE.unpack_from(data, offset)
+        offset += ROW_STATE.size
+        self.invaders = []
+        for _ in range(count):
+            column, x, exploded = INVADER_STATE.unpack_from(data, offset)
+            offset += INVADER_STATE.size
+            invader = self.formation[column]
+            invader.x = x
+            invader.set_exploded(exploded)
+            self.invaders.append(invader)
+        return offset
+
     # Iterable protocol
     def __iter__(self):
         return self.invaders.__iter__()
@@ -408,6 +726,8 @@ class InvaderSquadren:
                      InvaderRow(game, self, 3, INVADER_TYPE_2),
                      InvaderRow(game, self, 4, INVADER_TYPE_3),
                      InvaderRow(game, self, 5, INVADER_TYPE_3)]
+        # Every row the squadren started with, used to restore snapshots
+        self.formation = list(self.rows)
         self.direction = RIGHT
 
     def get_row_count(self):
@@ -415,7 +735,7 @@ class InvaderSquadren:
 
     def select_invader_row_for_bomb(self):
         if len(self.rows) != 0:
-            row = random.randint(0, self.get_row_count()) - 1
+            row = self.game.random.randint(0, self.get_row_count()) - 1
             self.rows[row].select_invader_for_bomb()
 
     def remove_invaders_if_exploded(self):
@@ -455,22 +775,40 @@ class InvaderSquadren:
         for row in self.rows:
             row.move_down()
 
+    def get_state(self):
+        parts = [SQUADREN_STATE.pack(self.direction.encode(), len(self.rows))]
+        for row in self.rows:
+            parts.append(row.get_state())
+        return b''.join(parts)
+
+    def set_state(self, data, offset):
+        direction, count = SQUADREN_STATE.unpack_from(data, offset)
+        offset += SQUADREN_STATE.size
+        self.direction = direction.decode()
+        self.rows = []
+        for _ in range(count):
+            # The row index is the first field of each row's state
+            row = self.formation[data[offset]]
+            offset = row.set_state(data, offset)
+            self.rows.append(row)
+        return offset
+
     # Iterable protocol
     def __iter__(self):
         return self.rows.__iter__()
 
 
 class Saucer(TargetObject):
+    layer = LAYER_SAUCER  # Drawn over the lasers and bombs
 
     def __init__(self, game):
         super().__init__(game, INVADER_SAUCER[0], SAUCER_SPEED)
         self.explosion_image = INVADER_SAUCER[1]
-        self.value = random.randint(1, INVADER_SAUCER[2])
+        self.value = game.random.randint(1, INVADER_SAUCER[2])
         self.x = 0
         self.y = INVADER_AREA_TOP - 20
         self.exploded = False
         self.sound = load_sound_file('resources/saucer.wav')
-        self.sound.play()
         self.explosion = load_sound_file('resources/saucer_explosion.wav')
 
     def move(self):
@@ -496,56 +834,60 @@ class BarrierBlock(DrawableGameObject):
         self.colour = colour
         self.x = x
         self.y = y
-        self.image = pygame.Surface((self.width, self.height))
-        self.image.fill(self.colour)
+        # One surface per colour, shared by every block
+        self.image = IMAGE_CACHE.make('barrier block ' + str(colour), self.create_image)
         self.rect = pygame.Rect(self.x, self.y, self.width, self.height)
+        # Blocks never move so the render queue entry is built once
+        self.entry = (self.image, (self.x, self.y))
+
 
+    def create_image(self):
+        image = pygame.Surface((self.width, self.height))
+        image.fill(self.colour)
+        return image
 
-    def draw(self):
-        self.game.display_surface.blit(self.image, (self.x, self.y))
+    def submit(self, queue):
+        queue.submit(LAYER_BARRIERS, self.image, (self.x, self.y))
 
 
     def check_for_collision(self):
-        for bomb in self.game.bombs:
-            if self.rect.colliderect(bomb.rect()):
-                # A bomb hit the barrier
-                self.game.bombs.remove(bomb)
-        for laser in self.game.lasers:
-            if self.rect.colliderect(laser.rect()):
-                # A bomb hit the barrier
-                self.game.lasers.remove(laser)
+        projectiles = self.game.projectiles
+        for owner in (OWNER_INVADER, OWNER_GUNSHIP):
+            # A bomb or laser hit the barrier
+            for index in projectiles.hits(self.rect, owner):
+                projectiles.kill(owner, index)
 
 class Barrier(DrawableGameObject):
 
     def __init__(self, game, width, height, colour, x, y):
         super().__init__(game)
         self.blocks = []
+        self.all_blocks = []
+        self.rect = pygame.Rect(x, y, width, height)
         width_range = int(width / 10)
         height_range = int(height / 10)
         for pos_x in range(width_range):
             for pos_y in range(height_range):
                 block = BarrierBlock(self.game, colour, x + int(pos_x * 10), y + int(pos_y * 10))
                 self.blocks.append(block)
+                self.all_blocks.append(block)
 
-    def draw(self):
-        for block in self.blocks:
-            block.draw()
+    def submit(self, queue):
+        # The entries are prebuilt, so the blocks are added in one go
+        queue.extend(LAYER_BARRIERS, [block.entry for block in self.blocks])
 
     def check_for_collision(self):
-        for bomb in self.game.bombs:
-            for block in self.blocks:
-                if block.rect.colliderect(bomb.rect()):
-                    # A bomb hit the barrier
-                    self.game.bombs.remove(bomb)
-                    self.blocks.remove(block)
-                    break
-        for laser in self.game.lasers:
-            for block in self.blocks:
-                if block.rect.colliderect(laser.rect()):
-                    # A laser hit the barrier
-                    self.game.lasers.remove(laser)
-                    self.blocks.remove(block)
-                    break
+        projectiles = self.game.projectiles
+        for owner in (OWNER_INVADER, OWNER_GUNSHIP):
+            # Only projectiles inside the barrier's outline can hit a block
+            rects = projectiles.rects[owner]
+            for index in self.rect.collidelistall(rects):
+                for block in self.blocks:
+                    if block.rect.colliderect(rects[index]):
+                        # A bomb or laser hit the barrier
+                        projectiles.kill(owner, index)
+                        self.blocks.remove(block)
+                        break
         for row in self.game.invaders.rows:
             for invader in row.invaders:
                 for block in self.blocks:
@@ -553,6 +895,21 @@ class Barrier(DrawableGameObject):
                         self.blocks.remove(block)
                         break
 
+    def get_state(self):
+        """ The remaining blocks as a bitmap over all_blocks """
+        remaining = set(map(id, self.blocks))
+        mask = 0
+        for index, block in enumerate(self.all_blocks):
+            if id(block) in remaining:
+                mask |= 1 << index
+        return mask.to_bytes((len(self.all_blocks) + 7) // 8, 'little')
+
+    def set_state(self, data, offset):
+        end = offset + (len(self.all_blocks) + 7) // 8
+        mask = int.from_bytes(data[offset:end], 'little')
+        self.blocks = [block for index, block in enumerate(self.all_blocks) if mask >> index & 1]
+        return end
+
 
 class Barriers:
     def __init__(self, game):
@@ -570,11 +927,33 @@ class Barriers:
         for barrier in self.barriers:
             barrier.check_for_collision()
 
+    def get_state(self):
+        parts = [BARRIERS_STATE.pack(len(self.barriers))]
+        for barrier in self.barriers:
+            parts.append(barrier.get_state())
+        return b''.join(parts)
+
+    def set_state(self, data, offset):
+        (count,) = BARRIERS_STATE.unpack_from(data, offset)
+        if count != len(self.barriers):
+            raise ValueError('Snapshot has ' + str(count) + ' barriers, expected ' + str(len(self.barriers)))
+        offset += BARRIERS_STATE.size
+        for barrier in self.barriers:
+            offset = barrier.set_state(data, offset)
+        return offset
+
     # Iterable protocol
     def __iter__(self):
         return self.barriers.__iter__()
 
 
+def load_font(filename, size):
+    key = (filename, size)
+    if key not in FONTS:
+        FONTS[key] = pygame.font.Font(filename, size)
+    return FONTS[key]
+
+
 def load_sound_file(filename):
     sound = None
     if filename in SOUNDS:
@@ -586,29 +965,272 @@ def load_sound_file(filename):
     return sound
 
 
+# Immutable record of everything needed to draw one frame. layers holds
+# a tuple of (surface, (x, y)) pairs for each render layer, finished is
+# set on the last frame of the game.
+FrameSnapshot = namedtuple('FrameSnapshot', ['number', 'layers', 'score', 'finished'])
+
+
+class RenderQueue:
+    """ Collects what is to be drawn each frame into one list per layer.
+    The lists are kept between frames and only cleared, and each layer
+    is drawn with a single Surface.blits call. """
+
+    def __init__(self, layers=NUMBER_OF_LAYERS):
+        self.layers = [[] for _ in range(layers)]
+
+    def clear(self):
+        for layer in self.layers:
+            layer.clear()
+
+    def submit(self, layer, surface, position):
+        self.layers[layer].append((surface, position))
+
+    def extend(self, layer, entries):
+        self.layers[layer].extend(entries)
+
+    def freeze(self):
+        """ An immutable copy of the layers with the entries in each
+        layer grouped by surface. Surfaces are ordered by the name they
+        are cached under so every run draws them in the same order. """
+        for layer in self.layers:
+            layer.sort(key=lambda entry: IMAGE_CACHE.name(entry[0]))
+        return tuple(tuple(layer) for layer in self.layers)
+
+
+def draw_layers(surface, layers):
+    """ Draws frozen render queue layers, returning the number of blit calls """
+    calls = 0
+    for layer in layers:
+        if layer:
+            surface.blits(layer, doreturn=False)
+            calls += 1
+    return calls
+
+
+class FrameHandoff:
+    """ Hands frames from the simulation thread to the main thread. Only
+    one frame is ever in flight, the simulation is not asked for the next
+    frame until this one has been taken, so a single slot is enough. The
+    Event does take a lock on every publish and take, once per frame. """
+
+    def __init__(self):
+        self.frame = None
+        self.ready = threading.Event()
+
+    def publish(self, frame):
+        self.frame = frame
+        self.ready.set()
+
+    def take(self):
+        """ Waits for the next frame to be published and returns it """
+        self.ready.wait()
+        self.ready.clear()
+        return self.frame
+
+
+class StageTimings:
+    """ Records when each stage of the frame pipeline ran, on whichever
+    thread ran it. The 'frame' stage is the main loop's critical path
+    (everything but the frame rate wait), compare it against a run
+    without --pipelined to see what overlapping the stages gained. """
+
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+        self.intervals = {}
+
+    def add(self, stage, start, end):
+        self.totals[stage] = self.totals.get(stage, 0.0) + end - start
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+        self.intervals.setdefault(stage, []).append((start, end))
+
+    def mean(self, stage):
+        if self.counts.get(stage, 0) == 0:
+            return 0.0
+        return self.totals[stage] / self.counts[stage]
+
+    def overlap(self, stages, other_stages):
+        """ Returns the seconds during which one of stages and one of
+        other_stages were running at the same time. The stages in each
+        group run one after another on a single thread, so each group's
+        intervals never overlap and can be swept through in order. """
+        first = sorted(interval for stage in stages for interval in self.intervals.get(stage, ()))
+        second = sorted(interval for stage in other_stages for interval in self.intervals.get(stage, ()))
+        total = 0.0
+        i = j = 0
+        while i < len(first) and j < len(second):
+            start = max(first[i][0], second[j][0])
+            end = min(first[i][1], second[j][1])
+            if end > start:
+                total += end - start
+            if first[i][1] < second[j][1]:
+                i += 1
+            else:
+                j += 1
+        return total
+
+    def report(self):
+        for stage in self.totals:
+            print('{0:>10}: {1:8.3f} ms/frame over {2} frames'.format(
+                stage, self.mean(stage) * 1000, self.counts[stage]))
+        frames = self.counts.get('frame', 0)
+        if frames > 0:
+            overlap = self.overlap(SIMULATION_STAGES, ('render',))
+            render = self.totals.get('render', 0.0)
+            share = overlap / render * 100 if render > 0 else 0.0
+            print('{0:>10}: {1:8.3f} ms/frame ({2:5.1f}% of render)'.format(
+                'overlap', overlap / frames * 1000, share))
+
+
+class StateUsage:
+    """ Records the wall clock and CPU time spent in each game state """
+
+    def __init__(self):
+        self.state = None
+        self.wall = {}
+        self.cpu = {}
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+
+    def change(self, state):
+        now = time.perf_counter()
+        cpu_now = time.process_time()
+        if self.state is not None:
+            self.wall[self.state] = self.wall.get(self.state, 0.0) + now - self.started
+            self.cpu[self.state] = self.cpu.get(self.state, 0.0) + cpu_now - self.cpu_started
+        self.state = state
+        self.started = now
+        self.cpu_started = cpu_now
+
+    def report(self):
+        for state in self.wall:
+            wall = self.wall[state]
+            busy = self.cpu[state] / wall * 100 if wall > 0 else 0.0
+            print('{0:>10}: {1:8.2f} s, CPU {2:8.3f} s ({3:5.1f}% of a core)'.format(
+                state, wall, self.cpu[state], busy))
+
+
+class SimulationThread(threading.Thread):
+    """ Simulates the next frame while the main thread draws the current
+    one. The main thread keeps the window, its events and all drawing,
+    this thread only changes game state. """
+
+    def __init__(self, game, handoff, timings):
+        super().__init__(name='simulation', daemon=True)
+        self.game = game
+        self.handoff = handoff
+        self.timings = timings
+        self.go = threading.Event()
+        self.running = True
+        self.error = None
+
+    def run(self):
+        try:
+            while True:
+                self.go.wait()
+                self.go.clear()
+                if not self.running:
+                    break
+                self.handoff.publish(self.game._simulate_frame(self.timings))
+        except Exception as error:
+            # Wake the main thread rather than leave it waiting for a frame
+            self.error = error
+            self.handoff.publish(None)
+            raise
+
+    def request_frame(self):
+        self.go.set()
+
+    def stop(self):
+        self.running = False
+        self.go.set()
+        self.join()
+
+
+class SnapshotRing:
+    """ Keeps the most recent snapshots of a game so that play can be
+    rewound, the oldest snapshots are discarded once the ring is full """
+
+    def __init__(self, game, size=SNAPSHOT_RING_SIZE):
+        self.game = game
+        self.snapshots = deque(maxlen=size)
+
+    def push(self):
+        self.snapshots.append(self.game.snapshot())
+
+    def rewind(self, steps=1):
+        """ Restores the game to the snapshot pushed steps pushes ago,
+        the newer snapshots are discarded """
+        if steps < 1 or steps > len(self.snapshots):
+            raise IndexError('Can not rewind ' + str(steps) + ' of ' + str(len(self.snapshots)) + ' snapshots')
+        for _ in range(steps - 1):
+            self.snapshots.pop()
+        self.game.restore(self.snapshots.pop())
+
+    def clear(self):
+        self.snapshots.clear()
+
+    def __len__(self):
+        return len(self.snapshots)
+
+
 class Game:
     """ Represents the game itself, holds the main game playing loop """
 
-    def __init__(self):
+    def __init__(self, pipelined=False, max_lasers=MAX_LASERS,
+                 laser_fire_interval=LASER_FIRE_INTERVAL, max_projectiles=MAX_PROJECTILES,
+                 headless=False, broadcast_address=None, pixel_collisions=True, seed=None):
         pygame.init()
         # Set up execution state
         self.is_running = True
-        # Set up the display
-        self.display_surface = pygame.display.set_mode((DISPLAY_WIDTH, DISPLAY_HEIGHT))
-        pygame.display.set_caption('Pyvaders!')
-        # Set up the background image
-        self.background = pygame.image.load(BACKGROUND_IMAGE).convert()
-        self.display_surface.blit(self.background, (0, 0))
+        # Set once the window is closed, unlike quitting with q nothing more is shown
+        self.window_closed = False
+        # Each game has its own generator so games sharing a process stay independent
+        self.random = random.Random(seed)
+        # Which screen is showing, see change_state()
+        self.state = None
+        self.state_usage = StateUsage()
+        # Simulate on a separate thread while the current frame is drawn
+        self.pipelined = pipelined
+        self.frame_number = 0
+        self.render_queue = RenderQueue()
+        # ACTION_ flags from the keyboard waiting for the next step
+        self.input_actions = deque()
+        # Publish every frame to spectators listening on this (host, port)
+        self.broadcast_address = broadcast_address
+        self.broadcaster = None
+        # Set up the display, headless games are never drawn so they have none
+        if headless:
+            # Images can only be converted once a display mode is set
+            if pygame.display.get_surface() is None:
+                pygame.display.set_mode((1, 1), pygame.HIDDEN)
+            self.display_surface = None
+            self.background = None
+        else:
+            self.display_surface = pygame.display.set_mode((DISPLAY_WIDTH, DISPLAY_HEIGHT))
+            pygame.display.set_caption('Pyvaders!')
+            # Set up the background image
+            self.background = pygame.image.load(BACKGROUND_IMAGE).convert()
+            self.display_surface.blit(self.background, (0, 0))
+        # Load every sprite, and so its mask, up front so the simulation
+        # never touches the disk
+        for filename in SPRITES:
+            IMAGE_CACHE.get(filename)
         # Used for timing within the program.
         self.clock = pygame.time.Clock()
         # Set up the gunship
         self.gunship = Gunship(self)
         # Set up the invaders
         self.invaders = InvaderSquadren(self)
-        # set up lasers
-        self.lasers = []
-        # set up bombs
-        self.bombs = []
+        # Test projectile hits against the sprites' pixels, not just their rects
+        self.pixel_collisions = pixel_collisions
+        # set up the lasers and bombs
+        self.projectiles = Projectiles(self, max_projectiles)
+        self.max_lasers = max_lasers
+        self.laser_fire_interval = laser_fire_interval
+        self.last_fired = None
+        self.cycle_count = 0
         # Game over flag
         self.is_game_over = False
         # Player object
@@ -618,126 +1240,205 @@ class Game:
         # Barriers
         self.barriers = Barriers(self)
 
+    def change_state(self, state):
+        self.state_usage.change(state)
+        self.state = state
+
+    def _wait_for_key(self, keys, redraw=None, timeout=None):
+        """ Sleeps until one of keys is pressed, the window is closed or
+        timeout seconds have passed, calling redraw whenever the window
+        has been exposed. Returns the key pressed or None. """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while not self.window_closed:
+            if deadline is None:
+                event = pygame.event.wait()
+            else:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                event = pygame.event.wait(max(1, int(remaining * 1000)))
+            if event.type == pygame.QUIT:
+                self.is_running = False
+                self.window_closed = True
+            elif event.type == pygame.KEYDOWN and event.key in keys:
+                return event.key
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED) and redraw is not None:
+                redraw()
+        return None
+
+    def _show_screen(self, screen):
+        self.display_surface.blit(screen, (0, 0))
+        # Update the display
+        pygame.display.update()
+
     def _display_welcome_screen(self):
-        self.display_surface.blit(self.background, (0, 0))
+        self.change_state(ATTRACT)
+        screen = self._render_welcome_screen()
+        self._show_screen(screen)
+        # Wait for space to be pressed
+        self._wait_for_key((pygame.K_SPACE,), lambda: self._show_screen(screen))
+
+    def _render_welcome_screen(self):
+        """ Draws the welcome screen once, it is only shown again if the window is exposed """
+        screen = self.background.copy()
         title = Text(FONT, 50, 'Space Invaders', WHITE, 50, 155)
-        title.draw(self.display_surface)
+        title.draw(screen)
         continue_text = Text(FONT, 25, 'Press space to continue', WHITE, 100, 225)
-        continue_text.draw(self.display_surface)
+        continue_text.draw(screen)
         invader_text = Text(FONT, 25, '   =   10 pts', PURPLE, 250, 270)
-        invader_text.draw(self.display_surface)
+        invader_text.draw(screen)
         image = IMAGE_CACHE.get(INVADER_TYPE_1[0])
-        self.display_surface.blit(image, (200, 270))
+        screen.blit(image, (200, 270))
         invader_text = Text(FONT, 25, '   =  20 pts', GREEN, 250, 320)
-        invader_text.draw(self.display_surface)
+        invader_text.draw(screen)
         image = IMAGE_CACHE.get(INVADER_TYPE_2[0])
-        self.display_surface.blit(image, (200, 320))
+        screen.blit(image, (200, 320))
         invader_text = Text(FONT, 25, '   =  30 pts', BLUE, 250, 370)
-        invader_text.draw(self.display_surface)
+        invader_text.draw(screen)
         image = IMAGE_CACHE.get(INVADER_TYPE_3[0])
-        self.display_surface.blit(image, (200, 370))
+        screen.blit(image, (200, 370))
         invader_text = Text(FONT, 25, '   =  ?????', RED, 250, 420)
-        invader_text.draw(self.display_surface)
+        invader_text.draw(screen)
         image = IMAGE_CACHE.get(INVADER_SAUCER[0])
-        self.display_surface.blit(image, (200, 420))
-        # Update the display
-        pygame.display.update()
-        # Wait for a key to be pressed
-        pygame.event.wait()
-        proceed = False
-        while not proceed:
-            for event in pygame.event.get():
-                if event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_SPACE:
-                        proceed = True
-                        break
+        screen.blit(image, (200, 420))
+        return screen
 
     def __display_gameover_message(self):
         """ Displays a message to the user on the screen """
+        if self.window_closed:
+            return
+        self.change_state(GAME_OVER)
+        screen = self.__render_gameover_message()
+        self._show_screen(screen)
+        self._wait_for_key((pygame.K_SPACE, pygame.K_q), lambda: self._show_screen(screen),
+                           GAME_OVER_DISPLAY_TIME)
+
+    def __render_gameover_message(self):
         x = DISPLAY_WIDTH / 2 - 100
         y = DISPLAY_HEIGHT / 2 - 10
-        self.display_surface.blit(self.background, (0, 0))
+        screen = self.background.copy()
         text = Text(FONT, 35, 'Game Over', WHITE, x, y)
-        text.draw(self.display_surface)
-        # Update the display
-        pygame.display.update()
+        text.draw(screen)
+        return screen
 
     def __pause(self):
-        paused = True
-        while paused:
-            for event in pygame.event.get():
-                if event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_p:
-                        paused = False
-                        break
-
-    def _draw_display(self):
-        # Clear the screen of current contents
-        self.display_surface.blit(self.background, (0, 0))
+        """ Sleeps until p is pressed again, the screen is left showing
+        the last frame. Called by play() between frames so the time spent
+        paused is not counted against any frame. """
+        # The last frame is still on the display surface, so exposing only needs an update
+        self._wait_for_key((pygame.K_p,), pygame.display.update)
+        self.change_state(PLAYING)
+
+    def _capture_frame(self):
+        """ Takes an immutable snapshot of the positions and images
+        of everything to be drawn this frame """
+        queue = self.render_queue
+        queue.clear()
 
         # Draw player details
-        self.player.draw()
+        self.player.submit(queue)
 
         # Draw the invaders and the gunship
-        self.gunship.draw()
+        self.gunship.submit(queue)
         for row in self.invaders.rows:
             for invader in row.invaders:
-                invader.draw()
+                invader.submit(queue)
 
-        # Draw the lasers
-        for laser in self.lasers:
-            laser.draw()
+        # Draw the lasers and bombs
+        self.projectiles.submit(queue)
 
-        # Draw the bombs
-        for bomb in self.bombs:
-            bomb.draw()
-
-        # Draw the saucer
+        # Draw the saucer, its layer keeps it over the lasers and bombs
         if self.saucer is not None:
-            self.saucer.draw()
+            self.saucer.submit(queue)
 
         # Draw the barriers
         for barrier in self.barriers:
-            barrier.draw()
+            barrier.submit(queue)
+
+        self.frame_number += 1
+        finished = self.is_game_over or self.invaders.is_empty()
+        return FrameSnapshot(self.frame_number, queue.freeze(), self.player.score, finished)
+
+    def _compose_frame(self, frame):
+        # Clear the screen of current contents
+        self.display_surface.blit(self.background, (0, 0))
+
+        draw_layers(self.display_surface, frame.layers)
+        self.player.draw_text(self.display_surface, frame.score)
+
+    def _render_frame(self, frame):
+        self._compose_frame(frame)
 
         # Update the display
         pygame.display.update()
 
+    def _simulate_frame(self, timings):
+        """ Applies the queued input, advances the game one cycle and
+        captures the frame to draw. Runs on the simulation thread when
+        pipelined, so it must not touch the display or the event queue. """
+        start = time.perf_counter()
+        # One action per key press, so several presses in a frame all count
+        while self.input_actions:
+            self.apply_actions(self.input_actions.popleft())
+        self.step()
+        simulated = time.perf_counter()
+        timings.add('simulate', start, simulated)
+
+        frame = self._capture_frame()
+        captured = time.perf_counter()
+        timings.add('capture', simulated, captured)
+
+        # Published once captured so spectators see the frame under the same number
+        if self.broadcaster is not None:
+            self.broadcaster.publish(self)
+            timings.add('broadcast', captured, time.perf_counter())
+        return frame
+
     def _check_can_fire(self):
-        return len(self.lasers) == 0
+        if self.projectiles.owned[OWNER_GUNSHIP] >= self.max_lasers:
+            return False
+        return self.last_fired is None or self.cycle_count - self.last_fired >= self.laser_fire_interval
 
     def _handle_user_input(self):
         # Work out what the user wants to do
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.is_running = False
+                self.window_closed = True
             elif event.type == pygame.KEYDOWN:
                 # Check to see which key is pressed
                 if event.key == pygame.K_RIGHT:
                     # Right arrow key has been pressed
                     # move the player right
-                    self.gunship.move_right()
+                    self.input_actions.append(ACTION_RIGHT)
                 elif event.key == pygame.K_LEFT:
                     # Left arrow has been pressed
                     # move the player left
-                    self.gunship.move_left()
+                    self.input_actions.append(ACTION_LEFT)
                 elif event.key == pygame.K_SPACE:
-                    if self._check_can_fire():
-                        self.gunship.fire_laser()
+                    self.input_actions.append(ACTION_FIRE)
                 elif event.key == pygame.K_p:
-                    self.__pause()
+                    self.change_state(PAUSED)
                 elif event.key == pygame.K_q:
                     self.is_running = False
 
-    def _move_game_objects(self):
+    def apply_actions(self, actions):
+        """ Carries out a combination of ACTION_ flags """
+        if actions & ACTION_LEFT:
+            self.gunship.move_left()
+        if actions & ACTION_RIGHT:
+            self.gunship.move_right()
+        if actions & ACTION_FIRE:
+            self.fire()
 
-        # Move the laser
-        for laser in self.lasers:
-            laser.move()
+    def fire(self):
+        if self._check_can_fire() and self.gunship.fire_laser():
+            self.last_fired = self.cycle_count
+
+    def _move_game_objects(self):
 
-        # Move the bombs
-        for bomb in self.bombs:
-            bomb.move()
+        # Move the lasers and bombs
+        self.projectiles.update()
 
         if self.saucer is not None:
             self.saucer.move()
@@ -760,9 +1461,10 @@ class Game:
             self.invaders.select_invader_row_for_bomb()
 
         if cycle_count % SAUCER_CYCLE_INTERVAL == 0:
-            indicator = random.randint(0, SAUCER_CYCLE_INTERVAL)
+            indicator = self.random.randint(0, SAUCER_CYCLE_INTERVAL)
             if (indicator % 2 == 0) and self.saucer is None:
                 self.saucer = Saucer(self)
+                self.saucer.sound.play()
 
     def __check_if_invaders_reached_gunship(self):
         return self.invaders.check_if_invaders_reached_gunship()
@@ -777,21 +1479,90 @@ class Game:
     def remove_saucer(self, saucer):
         self.saucer = None
 
+    def snapshot(self):
+        """ Serialises the simulation and random number generator state
+        into a compact binary buffer that restore() can read back """
+        last_fired = -1 if self.last_fired is None else self.last_fired
+        parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.cycle_count,
+                                      self.frame_number, last_fired, self.is_game_over),
+                 self.player.get_state(),
+                 self.gunship.get_state()]
+        if self.saucer is None:
+            parts.append(SAUCER_STATE.pack(False, 0, 0, 0, False))
+        else:
+            parts.append(SAUCER_STATE.pack(True, self.saucer.x, self.saucer.y,
+                                           self.saucer.value, self.saucer.exploded))
+        parts.append(self.invaders.get_state())
+        parts.append(self.barriers.get_state())
+        parts.append(self.projectiles.get_state())
+        version, internal_state, gauss_next = self.random.getstate()
+        parts.append(RANDOM_STATE.pack(version, *internal_state,
+                                       gauss_next is not None, gauss_next or 0.0))
+        return b''.join(parts)
+
+    def restore(self, data):
+        """ Returns the game to the state held in a snapshot() buffer """
+        data = memoryview(data)
+        magic, version, cycle_count, frame_number, last_fired, is_game_over = \
+            SNAPSHOT_HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('Not a game snapshot')
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version ' + str(version))
+        self.cycle_count = cycle_count
+        self.frame_number = frame_number
+        self.last_fired = None if last_fired == -1 else last_fired
+        self.is_game_over = is_game_over
+        offset = SNAPSHOT_HEADER.size
+        offset = self.player.set_state(data, offset)
+        offset = self.gunship.set_state(data, offset)
+        present, x, y, value, exploded = SAUCER_STATE.unpack_from(data, offset)
+        offset += SAUCER_STATE.size
+        if not present:
+            self.saucer = None
+        else:
+            if self.saucer is None:
+                self.saucer = Saucer(self)
+            self.saucer.x = x
+            self.saucer.y = y
+            self.saucer.value = value
+            self.saucer.exploded = exploded
+            if exploded:
+                self.saucer.image = IMAGE_CACHE.get(self.saucer.explosion_image)
+            else:
+                self.saucer.image = IMAGE_CACHE.get(self.saucer.filename)
+        offset = self.invaders.set_state(data, offset)
+        offset = self.barriers.set_state(data, offset)
+        offset = self.projectiles.set_state(data, offset)
+        # Restored last as creating a saucer above uses the generator
+        values = RANDOM_STATE.unpack_from(data, offset)
+        gauss_next = values[-1] if values[-2] else None
+        self.random.setstate((values[0], values[1:-2], gauss_next))
+
+    def save_snapshot(self, filename):
+        with open(filename, 'wb') as file:
+            file.write(self.snapshot())
+
+    def load_snapshot(self, filename):
+        with open(filename, 'rb') as file:
+            self.restore(file.read())
+
+    def step(self):
+        """ Advances the simulation by one cycle """
+        self.cycle_count += 1
+
+        self._check_for_cycle_events(self.cycle_count)
+
+        self._move_game_objects()
+
+        if self.__check_if_invaders_reached_gunship():
+            self.is_game_over = True
+
+        self._detect_collisions()
+
     def add_to_player(self, value):
         self.player.add_to_score(value)
 
-    def remove_laser(self, laser):
-        if not laser.persistent:
-            self.lasers.remove(laser)
-            return True
-        return False
-
-    def add_bomb(self, bomb):
-        self.bombs.append(bomb)
-
-    def add_laser(self, laser):
-        self.lasers.append(laser)
-
     def game_over(self):
         self.is_game_over = True
 
@@ -800,40 +1571,917 @@ class Game:
 
     def play(self):
         self._display_welcome_screen()
-        cycle_count = 0
-        while self.is_running and not self.is_game_over:
-            cycle_count += 1
+        self.change_state(PLAYING)
+        timings = StageTimings()
+        if self.broadcast_address is not None:
+            self.broadcaster = Broadcaster(self.broadcast_address)
+        if self.pipelined:
+            handoff = FrameHandoff()
+            simulator = SimulationThread(self, handoff, timings)
+            simulator.start()
+            simulator.request_frame()
+        while self.is_running:
+            if self.state == PAUSED:
+                self.__pause()
+                continue
+
+            frame_start = time.perf_counter()
 
             self._handle_user_input()
 
-            self._check_for_cycle_events(cycle_count)
-
-            self._move_game_objects()
-
-            if self.__check_if_invaders_reached_gunship():
-                self.is_game_over = True
-
-            self._detect_collisions()
-
-            self._draw_display()
+            if self.pipelined:
+                # Collect frame N and start simulating N + 1 while N is drawn
+                frame = handoff.take()
+                if frame is None:
+                    raise RuntimeError('Simulation thread failed') from simulator.error
+                if not frame.finished:
+                    simulator.request_frame()
+            else:
+                frame = self._simulate_frame(timings)
+
+            render_start = time.perf_counter()
+            self._render_frame(frame)
+            frame_end = time.perf_counter()
+            timings.add('render', render_start, frame_end)
+            timings.add('frame', frame_start, frame_end)
 
             # Defines the frame rate. The number is number of frames per second
             # Should be called once per frame (but only once)
             self.clock.tick(FRAME_REFRESH_RATE)
 
-            if self.__check_if_all_invaders_destoryed():
+            if frame.finished:
                 break
 
+        if self.pipelined:
+            simulator.stop()
+        timings.report()
+        if self.broadcaster is not None:
+            self.broadcaster.close()
+            self.broadcaster.report()
+            self.broadcaster = None
+
         self.__display_gameover_message()
+        self.change_state(None)
+        self.state_usage.report()
 
-        time.sleep(2)
-        # Let pygame shutdown gracefully
+        # Let pygame shutdown gracefully, the cached fonts can not outlive it
+        FONTS.clear()
         pygame.quit()
 
 
+# What a spectator needs to draw a frame. invaders maps an invader id to
+# (x, y, sprite), projectiles maps a projectile id to (x, y, velocity,
+# owner) and barriers holds each barrier's block bitmap as an int.
+Scene = namedtuple('Scene', ['score', 'lives', 'gunship', 'saucer', 'invaders',
+                             'projectiles', 'barriers'])
+
+
+def capture_scene(game):
+    """ Builds the quantised Scene for the game's current frame """
+    def sprite(target):
+        return SPRITE_INDEX[target.explosion_image if target.exploded else target.filename]
+
+    gunship = game.gunship
+    saucer = game.saucer
+    invaders = {}
+    for row in game.invaders.rows:
+        for invader in row.invaders:
+            invaders[row.index * MAX_INVADERS_IN_ROW + invader.column] = \
+                (int(invader.x), int(row.y), sprite(invader))
+    projectiles = {}
+    store = game.projectiles
+    for index in range(store.count):
+        if store.alive[index]:
+            projectiles[store.ids[index]] = (int(store.xs[index]), int(store.ys[index]),
+                                             int(store.velocities[index]), store.owners[index])
+    barriers = [int.from_bytes(barrier.get_state(), 'little') for barrier in game.barriers]
+    return Scene(game.player.score, game.player.lives,
+                 (int(gunship.x), int(gunship.y), sprite(gunship)),
+                 None if saucer is None else (int(saucer.x), int(saucer.y), sprite(saucer)),
+                 invaders, projectiles, barriers)
+
+
+def advance_projectiles(projectiles):
+    """ Where each projectile will be after one more update """
+    return {id: (x, y + velocity, velocity, owner)
+            for id, (x, y, velocity, owner) in projectiles.items()}
+
+
+def pack_saucer(saucer):
+    if saucer is None:
+        return FLAGS.pack(0)
+    return FLAGS.pack(1) + SPRITE_STATE.pack(*saucer)
+
+
+def unpack_saucer(data, offset):
+    (present,) = FLAGS.unpack_from(data, offset)
+    offset += FLAGS.size
+    if not present:
+        return None, offset
+    return SPRITE_STATE.unpack_from(data, offset), offset + SPRITE_STATE.size
+
+
+class SceneEncoder:
+    """ Turns each frame into a delta against the frame sent before it.
+    Invaders normally all move together so a delta holds a single shift
+    for the formation plus any invader that did something else.
+    Projectiles only move by their velocity so just their creation and
+    destruction is sent. Every keyframe_interval frames, or when asked,
+    the delta is followed by a keyframe of the same frame so spectators
+    can join or check what they have rebuilt. """
+
+    def __init__(self, keyframe_interval=SPECTATOR_KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.last = None
+        self.since_keyframe = 0
+        self.keyframes = 0
+        self.keyframe_bytes = 0
+
+    def encode(self, frame_number, scene, keyframe=False):
+        message = b''
+        if self.last is not None:
+            body = self.encode_delta(self.last, scene)
+            message = FRAME_HEADER.pack(FRAME_DELTA, frame_number, len(body)) + body
+        self.since_keyframe += 1
+        if keyframe or self.last is None or self.since_keyframe >= self.keyframe_interval:
+            body = self.encode_keyframe(scene)
+            message += FRAME_HEADER.pack(FRAME_KEY, frame_number, len(body)) + body
+            self.since_keyframe = 0
+            self.keyframes += 1
+            self.keyframe_bytes += FRAME_HEADER.size + len(body)
+        self.last = scene
+        return message
+
+    def encode_keyframe(self, scene):
+        parts = [SCORE_STATE.pack(scene.score, scene.lives),
+                 SPRITE_STATE.pack(*scene.gunship),
+                 pack_saucer(scene.saucer),
+                 COUNT.pack(len(scene.invaders))]
+        for id, state in scene.invaders.items():
+            parts.append(ENTITY_STATE.pack(id, *state))
+        parts.append(COUNT.pack(len(scene.projectiles)))
+        for id, state in scene.projectiles.items():
+            parts.append(PROJECTILE_STATE.pack(id, *state))
+        parts.append(FLAGS.pack(len(scene.barriers)))
+        for mask in scene.barriers:
+            bitmap = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+            parts.append(FLAGS.pack(len(bitmap)) + bitmap)
+        return b''.join(parts)
+
+    def encode_delta(self, last, scene):
+        flags = 0
+        parts = []
+        if (scene.score, scene.lives) != (last.score, last.lives):
+            flags |= DELTA_SCORE
+            parts.append(SCORE_STATE.pack(scene.score, scene.lives))
+        if scene.gunship != last.gunship:
+            flags |= DELTA_GUNSHIP
+            parts.append(SPRITE_STATE.pack(*scene.gunship))
+        if scene.saucer != last.saucer:
+            flags |= DELTA_SAUCER
+            parts.append(pack_saucer(scene.saucer))
+
+        # Invaders, the most common move becomes the formation shift
+        moves = Counter((x - last.invaders[id][0], y - last.invaders[id][1])
+                        for id, (x, y, _) in scene.invaders.items() if id in last.invaders)
+        dx, dy = moves.most_common(1)[0][0] if moves else (0, 0)
+        if not (-128 <= dx < 128 and -128 <= dy < 128):
+            dx, dy = 0, 0
+        parts.append(SHIFT_STATE.pack(dx, dy))
+        removed = [id for id in last.invaders if id not in scene.invaders]
+        parts.append(COUNT.pack(len(removed)))
+        parts.extend(INVADER_ID.pack(id) for id in removed)
+        changed = []
+        for id, state in scene.invaders.items():
+            previous = last.invaders.get(id)
+            if previous is None or state != (previous[0] + dx, previous[1] + dy, previous[2]):
+                changed.append(ENTITY_STATE.pack(id, *state))
+        parts.append(COUNT.pack(len(changed)))
+        parts.extend(changed)
+
+        # Projectiles that did not simply carry on are destroyed and recreated
+        expected = advance_projectiles(last.projectiles)
+        destroyed = [id for id, state in expected.items() if scene.projectiles.get(id) != state]
+        created = [(id, state) for id, state in scene.projectiles.items() if expected.get(id) != state]
+        parts.append(COUNT.pack(len(destroyed)))
+        parts.extend(PROJECTILE_ID.pack(id) for id in destroyed)
+        parts.append(COUNT.pack(len(created)))
+        parts.extend(PROJECTILE_STATE.pack(id, *state) for id, state in created)
+
+        # Barrier blocks that have appeared or disappeared
+        cells = []
+        for barrier, (before, after) in enumerate(zip(last.barriers, scene.barriers)):
+            toggled = before ^ after
+            while toggled:
+                block = toggled.bit_length() - 1
+                cells.append(CELL_STATE.pack(barrier, block))
+                toggled ^= 1 << block
+        parts.append(COUNT.pack(len(cells)))
+        parts.extend(cells)
+        return FLAGS.pack(flags) + b''.join(parts)
+
+
+class SceneDecoder:
+    """ Rebuilds the Scene from a stream written by SceneEncoder """
+
+    def __init__(self):
+        self.scene = None
+
+    def decode(self, kind, body):
+        if kind == FRAME_KEY:
+            self.scene = self.decode_keyframe(body)
+        elif kind == FRAME_DELTA:
+            if self.scene is None:
+                raise ValueError('Delta frame received before a keyframe')
+            self.scene = self.decode_delta(self.scene, body)
+        else:
+            raise ValueError('Unknown frame type ' + str(kind))
+        return self.scene
+
+    def decode_keyframe(self, body):
+        score, lives = SCORE_STATE.unpack_from(body, 0)
+        offset = SCORE_STATE.size
+        gunship = SPRITE_STATE.unpack_from(body, offset)
+        offset += SPRITE_STATE.size
+        saucer, offset = unpack_saucer(body, offset)
+        invaders = {}
+        (count,) = COUNT.unpack_from(body, offset)
+        offset += COUNT.size
+        for _ in range(count):
+            id, x, y, sprite = ENTITY_STATE.unpack_from(body, offset)
+            offset += ENTITY_STATE.size
+            invaders[id] = (x, y, sprite)
+        projectiles = {}
+        (count,) = COUNT.unpack_from(body, offset)
+        offset += COUNT.size
+        for _ in range(count):
+            id, x, y, velocity, owner = PROJECTILE_STATE.unpack_from(body, offset)
+            offset += PROJECTILE_STATE.size
+            projectiles[id] = (x, y, velocity, owner)
+        barriers = []
+        (count,) = FLAGS.unpack_from(body, offset)
+        offset += FLAGS.size
+        for _ in range(count):
+            (length,) = FLAGS.unpack_from(body, offset)
+            offset += FLAGS.size
+            barriers.append(int.from_bytes(body[offset:offset + length], 'little'))
+            offset += length
+        return Scene(score, lives, gunship, saucer, invaders, projectiles, barriers)
+
+    def decode_delta(self, last, body):
+        (flags,) = FLAGS.unpack_from(body, 0)
+        offset = FLAGS.size
+        score, lives, gunship, saucer = last.score, last.lives, last.gunship, last.saucer
+        if flags & DELTA_SCORE:
+            score, lives = SCORE_STATE.unpack_from(body, offset)
+            offset += SCORE_STATE.size
+        if flags & DELTA_GUNSHIP:
+            gunship = SPRITE_STATE.unpack_from(body, offset)
+            offset += SPRITE_STATE.size
+        if flags & DELTA_SAUCER:
+            saucer, offset = unpack_saucer(body, offset)
+
+        dx, dy = SHIFT_STATE.unpack_from(body, offset)
+        offset += SHIFT_STATE.size
+        (count,) = COUNT.unpack_from(body, offset)
+        offset += COUNT.size
+        removed = set()
+        for _ in range(count):
+            removed.add(INVADER_ID.unpack_from(body, offset)[0])
+            offset += INVADER_ID.size
+        invaders = {id: (x + dx, y + dy, sprite) for id, (x, y, sprite) in last.invaders.items()
+                    if id not in removed}
+        (count,) = COUNT.unpack_from(body, offset)
+        offset += COUNT.size
+        for _ in range(count):
+            id, x, y, sprite = ENTITY_STATE.unpack_from(body, offset)
+            offset += ENTITY_STATE.size
+            invaders[id] = (x, y, sprite)
+
+        projectiles = advance_projectiles(last.projectiles)
+        (count,) = COUNT.unpack_from(body, offset)
+        offset += COUNT.size
+        for _ in range(count):
+            del projectiles[PROJECTILE_ID.unpack_from(body, offset)[0]]
+            offset += PROJECTILE_ID.size
+        (count,) = COUNT.unpack_from(body, offset)
+        offset += COUNT.size
+        for _ in range(count):
+            id, x, y, velocity, owner = PROJECTILE_STATE.unpack_from(body, offset)
+            offset += PROJECTILE_STATE.size
+            projectiles[id] = (x, y, velocity, owner)
+
+        barriers = list(last.barriers)
+        (count,) = COUNT.unpack_from(body, offset)
+        offset += COUNT.size
+        for _ in range(count):
+            barrier, block = CELL_STATE.unpack_from(body, offset)
+            offset += CELL_STATE.size
+            barriers[barrier] ^= 1 << block
+        return Scene(score, lives, gunship, saucer, invaders, projectiles, barriers)
+
+
+class Spectator:
+    """ Connects to a broadcasting game, rebuilds every frame from the
+    stream and draws it. Each keyframe after the first is checked
+    against the scene rebuilt from the deltas before it. """
+
+    def __init__(self, address, display=True):
+        self.socket = socket.create_connection(address)
+        self.decoder = SceneDecoder()
+        self.frame_number = None
+        self.frames = 0
+        self.keyframes_checked = 0
+        self.mismatches = 0
+        self.display_surface = None
+        if display:
+            pygame.init()
+            self.display_surface = pygame.display.set_mode((DISPLAY_WIDTH, DISPLAY_HEIGHT))
+            pygame.display.set_caption('Pyvaders! (spectating)')
+            self.background = pygame.image.load(BACKGROUND_IMAGE).convert()
+            self.barriers = Barriers(self)
+            self.projectile_images = (IMAGE_CACHE.get(LASER), IMAGE_CACHE.get(BOMB))
+            self.scoreText = Text(FONT, 15, 'Score', WHITE, 5, 5)
+            self.livesText = Text(FONT, 15, 'Lives ', WHITE, DISPLAY_WIDTH - 180, LIVES_Y_POSITION + 4)
+
+    def receive(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                raise EOFError('Broadcast ended')
+            data.extend(chunk)
+        return bytes(data)
+
+    def read_frame(self):
+        """ Reads and applies one frame, returning its number """
+        kind, number, length = FRAME_HEADER.unpack(self.receive(FRAME_HEADER.size))
+        body = self.receive(length)
+        if kind == FRAME_DELTA and self.decoder.scene is None:
+            # Joined part way through, wait for the next keyframe
+            return None
+        rebuilt = self.decoder.scene
+        scene = self.decoder.decode(kind, body)
+        if kind == FRAME_KEY and rebuilt is not None and number == self.frame_number:
+            self.keyframes_checked += 1
+            if scene != rebuilt:
+                self.mismatches += 1
+                print('Frame ' + str(number) + ' rebuilt from deltas does not match its keyframe')
+        else:
+            self.frames += 1
+        self.frame_number = number
+        return number
+
+    def draw(self, scene):
+        surface = self.display_surface
+        surface.blit(self.background, (0, 0))
+        for x, y, sprite in scene.invaders.values():
+            surface.blit(IMAGE_CACHE.get(SPRITES[sprite]), (x, y))
+        x, y, sprite = scene.gunship
+        surface.blit(IMAGE_CACHE.get(SPRITES[sprite]), (x, y))
+        if scene.saucer is not None:
+            x, y, sprite = scene.saucer
+            surface.blit(IMAGE_CACHE.get(SPRITES[sprite]), (x, y))
+        surface.blits([(self.projectile_images[owner], (x, y))
+                       for x, y, velocity, owner in scene.projectiles.values()], doreturn=False)
+        for barrier, mask in zip(self.barriers, scene.barriers):
+            for index, block in enumerate(barrier.all_blocks):
+                if mask >> index & 1:
+                    surface.blit(block.image, (block.x, block.y))
+        self.scoreText.draw(surface)
+        Text(FONT, 15, str(scene.score), GREEN, 85, 5).draw(surface)
+        self.livesText.draw(surface)
+        Text(FONT, 15, str(scene.lives), GREEN, DISPLAY_WIDTH - 90, LIVES_Y_POSITION + 4).draw(surface)
+        pygame.display.update()
+
+    def watch(self):
+        drawn = None
+        try:
+            while True:
+                number = self.read_frame()
+                if self.display_surface is not None and number is not None and number != drawn:
+                    for event in pygame.event.get():
+                        if event.type == pygame.QUIT:
+                            return
+                    self.draw(self.decoder.scene)
+                    drawn = number
+        except EOFError:
+            pass
+        finally:
+            self.socket.close()
+            print(str(self.frames) + ' frames received, ' + str(self.keyframes_checked) +
+                  ' keyframes checked, ' + str(self.mismatches) + ' mismatches')
+
+
+class Broadcaster:
+    """ Publishes every frame of a game to any number of spectators over
+    a local TCP socket. Sockets are non-blocking so a slow spectator
+    never holds up the game; one that falls too far behind is dropped. """
+
+    def __init__(self, address, keyframe_interval=SPECTATOR_KEYFRAME_INTERVAL):
+        self.listener = socket.create_server(address)
+        self.listener.setblocking(False)
+        self.encoder = SceneEncoder(keyframe_interval)
+        # Each spectator is a [socket, unsent bytes] pair
+        self.spectators = []
+        self.frames = 0
+        self.total_bytes = 0
+        self.encode_time = 0.0
+        print('Broadcasting on ' + str(address[0]) + ':' + str(address[1]))
+
+    def accept(self):
+        joined = False
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except BlockingIOError:
+                return joined
+            connection.setblocking(False)
+            self.spectators.append([connection, bytearray()])
+            joined = True
+
+    def publish(self, game):
+        # New spectators need a keyframe before they can follow deltas
+        keyframe = self.accept()
+        if not self.spectators:
+            return
+        start = time.perf_counter()
+        message = self.encoder.encode(game.frame_number, capture_scene(game), keyframe)
+        self.encode_time += time.perf_counter() - start
+        self.frames += 1
+        self.total_bytes += len(message)
+        for spectator in list(self.spectators):
+            connection, unsent = spectator
+            unsent.extend(message)
+            try:
+                sent = connection.send(unsent)
+                del unsent[:sent]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.spectators.remove(spectator)
+                connection.close()
+                continue
+            if len(unsent) > SPECTATOR_MAX_BUFFER:
+                print('Dropping a spectator that has fallen behind')
+                self.spectators.remove(spectator)
+                connection.close()
+
+    def close(self):
+        """ Sends what the spectators have not yet been sent, giving up
+        on any still unsent after SPECTATOR_CLOSE_TIMEOUT """
+        deadline = time.perf_counter() + SPECTATOR_CLOSE_TIMEOUT
+        for connection, unsent in self.spectators:
+            remaining = deadline - time.perf_counter()
+            if unsent and remaining > 0:
+                try:
+                    connection.settimeout(remaining)
+                    connection.sendall(unsent)
+                except OSError:
+                    # Includes the timeout, the spectator just misses the end
+                    pass
+            connection.close()
+        self.spectators = []
+        self.listener.close()
+
+    def report(self):
+        if self.frames == 0:
+            return
+        keyframes = self.encoder.keyframes
+        delta_bytes = self.total_bytes - self.encoder.keyframe_bytes
+        print('Broadcast {0} frames, {1:.1f} bytes/frame, keyframes {2:.1f} bytes, '
+              'deltas {3:.1f} bytes, encode {4:.3f} ms/frame'.format(
+                  self.frames, self.total_bytes / self.frames,
+                  self.encoder.keyframe_bytes / max(keyframes, 1),
+                  delta_bytes / max(self.frames - 1, 1),
+                  self.encode_time / self.frames * 1000))
+
+
+class Session:
+    """ A headless game being played by one remote client """
+
+    def __init__(self, game, writer):
+        self.game = game
+        self.writer = writer
+        self.pending = deque()
+        self.room = asyncio.Event()
+        self.finished = False
+        # RESET restores this rather than building a new game
+        self.initial = game.snapshot()
+        # Set while waiting for the client to read the replies already sent
+        self.drain_task = None
+
+
+class ServerStats:
+    """ Counts steps and finished games and records step latencies """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.steps = 0
+        self.finished = 0
+        self.latencies = []
+
+    def report(self, sessions):
+        elapsed = time.perf_counter() - self.started
+        if elapsed == 0 or self.steps == 0:
+            return
+        latencies = sorted(self.latencies)
+        percentiles = [latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+                       for p in (0.5, 0.9, 0.99)]
+        print('{0} sessions, {1:.0f} steps/s, {2:.1f} games finished/s, '
+              'step latency p50 {3:.3f} ms p90 {4:.3f} ms p99 {5:.3f} ms'.format(
+                  sessions, self.steps / elapsed, self.finished / elapsed, *percentiles))
+
+
+class GameServer:
+    """ Hosts many headless games in one process. Requests from all
+    clients are queued per session and a single stepper task works
+    through them in batches, at most step_budget steps per session per
+    batch. A session's socket stops being read while it has max_pending
+    requests queued, which pushes back on clients that send too fast,
+    and a session is skipped while its unread replies are over the
+    transport's high water mark, so a slow reader only stalls itself. """
+
+    def __init__(self, game_options=None, step_budget=SESSION_STEP_BUDGET,
+                 max_pending=SESSION_MAX_PENDING):
+        self.game_options = game_options or {}
+        self.step_budget = step_budget
+        self.max_pending = max_pending
+        self.sessions = []
+        self.work = asyncio.Event()
+        self.stats = ServerStats()
+
+    def new_game(self):
+        return Game(headless=True, **self.game_options)
+
+    async def handle_client(self, reader, writer):
+        session = Session(self.new_game(), writer)
+        self.sessions.append(session)
+        try:
+            while True:
+                header = await reader.readexactly(MESSAGE_HEADER.size)
+                kind, length = MESSAGE_HEADER.unpack(header)
+                if kind not in (MSG_STEP, MSG_OBSERVE, MSG_RESET):
+                    print('Closing session after unknown message type ' + str(kind))
+                    break
+                payload = await reader.readexactly(length)
+                while len(session.pending) >= self.max_pending:
+                    session.room.clear()
+                    await session.room.wait()
+                session.pending.append((kind, payload, time.perf_counter()))
+                self.work.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The client has gone away
+            pass
+        finally:
+            self.sessions.remove(session)
+            writer.close()
+
+    def handle_message(self, session, kind, payload):
+        game = session.game
+        if kind == MSG_OBSERVE:
+            data = game.snapshot()
+            return MESSAGE_HEADER.pack(MSG_SNAPSHOT, len(data)) + data
+        if kind == MSG_RESET:
+            game.restore(session.initial)
+            if self.game_options.get('seed') is None:
+                # Restoring also restored the generator, start a different game
+                game.random.seed()
+            session.finished = False
+        elif not game.is_game_over:
+            game.apply_actions(payload[0] if payload else 0)
+            game.step()
+            self.stats.steps += 1
+            if game.invaders.is_empty():
+                game.game_over()
+        if game.is_game_over and not session.finished:
+            session.finished = True
+            self.stats.finished += 1
+        data = STATE_MESSAGE.pack(game.cycle_count, game.player.score, game.player.lives,
+                                  game.is_game_over, game.gunship.x,
+                                  sum(len(row.invaders) for row in game.invaders.rows),
+                                  game.projectiles.count)
+        return MESSAGE_HEADER.pack(MSG_STATE, len(data)) + data
+
+    async def run_steps(self):
+        """ Works through the queued requests one batch per event loop tick """
+        while True:
+            await self.work.wait()
+            self.work.clear()
+            for session in self.sessions:
+                if session.drain_task is not None:
+                    continue
+                for _ in range(min(self.step_budget, len(session.pending))):
+                    kind, payload, received = session.pending.popleft()
+                    session.writer.write(self.handle_message(session, kind, payload))
+                    self.stats.latencies.append(time.perf_counter() - received)
+                session.room.set()
+                transport = session.writer.transport
+                if transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+                    # The client is not keeping up with its replies
+                    session.drain_task = asyncio.create_task(self.drain(session))
+                elif session.pending:
+                    self.work.set()
+            # Give the connection readers a chance to queue the next batch
+            await asyncio.sleep(0)
+
+    async def drain(self, session):
+        """ Waits for one session's client to catch up with its replies
+        without holding up the other sessions """
+        try:
+            await session.writer.drain()
+        except ConnectionError:
+            # The client has gone away, handle_client cleans up
+            pass
+        session.drain_task = None
+        self.work.set()
+
+    async def run_reports(self, interval=SERVER_REPORT_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            self.stats.report(len(self.sessions))
+            self.stats.reset()
+
+
+async def run_local_client(host, port, path, steps):
+    """ A client that plays random moves, used to load test the server """
+    if path is None:
+        reader, writer = await asyncio.open_connection(host, port)
+    else:
+        reader, writer = await asyncio.open_unix_connection(path)
+    for _ in range(steps):
+        actions = random.choice((0, ACTION_LEFT, ACTION_RIGHT, ACTION_FIRE))
+        writer.write(MESSAGE_HEADER.pack(MSG_STEP, 1) + bytes((actions,)))
+        kind, length = MESSAGE_HEADER.unpack(await reader.readexactly(MESSAGE_HEADER.size))
+        state = STATE_MESSAGE.unpack(await reader.readexactly(length))
+        if state[3]:
+            # The game is over so start another
+            writer.write(MESSAGE_HEADER.pack(MSG_RESET, 0))
+            await reader.readexactly(MESSAGE_HEADER.size + STATE_MESSAGE.size)
+    writer.close()
+    await writer.wait_closed()
+
+
+async def run_server(host=SERVER_HOST, port=SERVER_PORT, path=None, game_options=None,
+                     clients=0, steps=1000):
+    server = GameServer(game_options)
+    if path is None:
+        listener = await asyncio.start_server(server.handle_client, host, port)
+        print('Serving games on ' + host + ':' + str(port))
+    else:
+        listener = await asyncio.start_unix_server(server.handle_client, path)
+        print('Serving games on ' + path)
+    tasks = [asyncio.create_task(server.run_steps()),
+             asyncio.create_task(server.run_reports())]
+    try:
+        async with listener:
+            if clients == 0:
+                await listener.serve_forever()
+            else:
+                # Benchmark against local clients then stop
+                server.stats.reset()
+                await asyncio.gather(*(run_local_client(host, port, path, steps)
+                                       for _ in range(clients)))
+                server.stats.report(clients)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, path=None, game_options=None, clients=0, steps=1000):
+    """ Runs the game session server, no window is opened and no
+    sound is played """
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    asyncio.run(run_server(host, port, path, game_options, clients, steps))
+
+
+def benchmark_snapshots(game, iterations=10000):
+    """ Reports the snapshot size and how quickly snapshots can be
+    taken and restored for a game part way through a wave """
+    game.random.seed(0)
+    ring = SnapshotRing(game)
+    for _ in range(FRAME_REFRESH_RATE * 10):
+        game.fire()
+        game.step()
+        ring.push()
+    data = game.snapshot()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        game.snapshot()
+    save_time = (time.perf_counter() - start) / iterations
+    start = time.perf_counter()
+    for _ in range(iterations):
+        game.restore(data)
+    restore_time = (time.perf_counter() - start) / iterations
+    start = time.perf_counter()
+    ring.rewind(len(ring))
+    rewind_time = time.perf_counter() - start
+    print('Snapshot size: ' + str(len(data)) + ' bytes')
+    print('Save:    {0:8.2f} us  {1:8.1f} MB/s'.format(save_time * 1e6, len(data) / save_time / 1e6))
+    print('Restore: {0:8.2f} us  {1:8.1f} MB/s'.format(restore_time * 1e6, len(data) / restore_time / 1e6))
+    print('Rewind:  {0:8.2f} us'.format(rewind_time * 1e6))
+
+
+def benchmark_collisions(game, iterations=50, repeats=5):
+    """ Times a frame's collision detection, Game._detect_collisions,
+    with and without the pixel mask narrow phase over game states taken
+    from the middle of a wave. Each state is restored before it is
+    timed and the best of repeats runs is kept.
+
+    As a secondary figure Projectiles.hits and first_hit are timed on
+    their own. An invader is surrounded by a laser at every offset where
+    their rects overlap, and a second set holds only the near misses,
+    lasers whose rects overlap the invader but whose pixels do not
+    touch it. """
+    game.random.seed(0)
+    game.max_lasers = game.projectiles.capacity
+    states = []
+    in_flight = 0
+    # Fill the screen with lasers and bombs, then keep every fifth frame
+    for cycle in range(FRAME_REFRESH_RATE * 5):
+        game.random.choice((game.gunship.move_left, game.gunship.move_right))()
+        game.fire()
+        game.invaders.select_invader_row_for_bomb()
+        game.step()
+        if cycle >= FRAME_REFRESH_RATE * 2 and cycle % 5 == 0:
+            states.append(game.snapshot())
+            in_flight += game.projectiles.count
+    print('Frame collisions over {0} mid wave states, {1:.0f} projectiles in flight on average'.format(
+        len(states), in_flight / len(states)))
+    results = {}
+    for pixel_collisions, label in ((False, 'Rects only'), (True, 'With masks')):
+        game.pixel_collisions = pixel_collisions
+        best = None
+        for _ in range(repeats):
+            elapsed = 0.0
+            for _ in range(iterations):
+                for data in states:
+                    game.restore(data)
+                    start = time.perf_counter()
+                    game._detect_collisions()
+                    elapsed += time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[pixel_collisions] = best / (iterations * len(states))
+        print('  {0:>10}: {1:8.2f} us per frame'.format(label, results[pixel_collisions] * 1e6))
+    print('  Mask narrow phase costs {0:.2f}x the rect only checks'.format(
+        results[True] / results[False]))
+
+
+    invader = next(invader for row in game.invaders.rows for invader in row.invaders
+                   if not invader.exploded)
+    rect = invader.rect()
+    mask = invader.mask()
+    laser_mask = MASK_CACHE.get(LASER)
+    width, height = laser_mask.get_size()
+    offsets = [(x, y) for x in range(rect.left - width + 1, rect.right)
+               for y in range(rect.top - height + 1, rect.bottom)]
+    near_misses = [(x, y) for x, y in offsets
+                   if mask.overlap(laser_mask, (x - rect.x, y - rect.y)) is None]
+
+    def surround(positions):
+        projectiles = Projectiles(game, len(positions))
+        for x, y in positions:
+            projectiles.spawn(OWNER_GUNSHIP, x, y, 0)
+        projectiles.reindex()
+        return projectiles
+
+    def time_call(function, *args):
+        calls = iterations * 10
+        start = time.perf_counter()
+        for _ in range(calls):
+            function(*args)
+        return (time.perf_counter() - start) / calls
+
+    print('Narrow phase alone')
+    for label, positions in (('All overlaps', offsets), ('Near misses', near_misses)):
+        projectiles = surround(positions)
+        print('{0}: {1} lasers overlap the invader\'s rect, {2} touch its pixels'.format(
+            label, len(projectiles.hits(rect, OWNER_GUNSHIP)),
+            len(projectiles.hits(rect, OWNER_GUNSHIP, mask))))
+        for name in ('hits', 'first_hit'):
+            function = getattr(projectiles, name)
+            rects_only = time_call(function, rect, OWNER_GUNSHIP)
+            with_mask = time_call(function, rect, OWNER_GUNSHIP, mask)
+            print('  {0:>9}: rects only {1:8.2f} us, with mask {2:8.2f} us ({3:.1f}x)'.format(
+                name, rects_only * 1e6, with_mask * 1e6, with_mask / rects_only))
+
+
+def benchmark_rendering(game, iterations=1000):
+    """ Compares capturing and drawing a frame the way it was done
+    before the render queue, every object blitted on its own and the
+    score text rendered every frame, against the render queue with one
+    blits call per layer """
+    game.random.seed(0)
+    for _ in range(FRAME_REFRESH_RATE):
+        game.random.choice((game.gunship.move_left, game.gunship.move_right))()
+        game.fire()
+        game.step()
+    surface = game.display_surface
+    player = game.player
+
+    def draw_each_object():
+        blits = list(player.life_blits())
+        blits.append((game.gunship.image, (game.gunship.x, game.gunship.y)))
+        for row in game.invaders.rows:
+            for invader in row.invaders:
+                blits.append((invader.image, (invader.x, row.y)))
+        if game.saucer is not None:
+            blits.append((game.saucer.image, (game.saucer.x, game.saucer.y)))
+        for barrier in game.barriers:
+            for block in barrier.blocks:
+                blits.append((block.image, (block.x, block.y)))
+        projectiles = tuple(game.projectiles.blits())
+        surface.blit(game.background, (0, 0))
+        for image, position in tuple(blits):
+            surface.blit(image, position)
+        surface.blits(projectiles, doreturn=False)
+        player.livesText.draw(surface)
+        player.scoreText.draw(surface)
+        Text(FONT, 15, str(player.score), GREEN, 85, 5).draw(surface)
+
+    def draw_render_queue():
+        game._compose_frame(game._capture_frame())
+
+    frame = game._capture_frame()
+    objects = sum(len(layer) for layer in frame.layers)
+    sprites = objects - len(frame.layers[LAYER_PROJECTILES])
+    batches = sum(1 for layer in frame.layers if layer)
+    # Both also blit the background and the lives, score and score value text
+    fixed_calls = 4
+    for label, draw, calls in (('Per object', draw_each_object, sprites + 1),
+                               ('Render queue', draw_render_queue, batches)):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            draw()
+        elapsed = (time.perf_counter() - start) / iterations
+        print('{0:>12}: {1:4} blit calls per frame, {2:8.1f} us per frame'.format(
+            label, calls + fixed_calls, elapsed * 1e6))
+    print(str(objects) + ' objects drawn in ' + str(batches) + ' layers')
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Pyvaders!')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='simulate the next frame on a separate thread while the current one is drawn')
+    parser.add_argument('--max-lasers', type=int, default=MAX_LASERS,
+                        help='number of lasers the gunship can have on screen at once')
+    parser.add_argument('--fire-interval', type=int, default=LASER_FIRE_INTERVAL,
+                        help='minimum number of cycles between laser shots')
+    parser.add_argument('--max-projectiles', type=int, default=MAX_PROJECTILES,
+                        help='total number of lasers and bombs allowed in flight')
+    parser.add_argument('--benchmark-snapshots', action='store_true',
+                        help='report snapshot size and save/restore speed then exit')
+    parser.add_argument('--seed', type=int,
+                        help='seed for the game\'s random number generator')
+    parser.add_argument('--rect-collisions', action='store_true',
+                        help='only test bounding rects for hits, not the sprites\' pixels')
+    parser.add_argument('--benchmark-collisions', action='store_true',
+                        help='compare rect only and pixel mask collision detection then exit')
+    parser.add_argument('--benchmark-rendering', action='store_true',
+                        help='compare per object and batched drawing then exit')
+    parser.add_argument('--serve', action='store_true',
+                        help='host headless games for remote clients instead of playing')
+    parser.add_argument('--host', default=SERVER_HOST, help='address the server listens on')
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help='port the server listens on')
+    parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--clients', type=int, default=0,
+                        help='benchmark the server with this many local clients then exit')
+    parser.add_argument('--steps', type=int, default=1000, help='steps each benchmark client plays')
+    parser.add_argument('--broadcast', action='store_true',
+                        help='publish every frame to spectators connecting to --spectator-port')
+    parser.add_argument('--spectate', action='store_true',
+                        help='watch a broadcasting game on --host and --spectator-port')
+    parser.add_argument('--spectator-port', type=int, default=SPECTATOR_PORT,
+                        help='port used by --broadcast and --spectate')
+    args = parser.parse_args()
+    if not 0 <= args.max_projectiles <= MAX_PROJECTILE_CAPACITY:
+        parser.error('--max-projectiles must be between 0 and ' + str(MAX_PROJECTILE_CAPACITY))
+    game_options = dict(max_lasers=args.max_lasers, laser_fire_interval=args.fire_interval,
+                        max_projectiles=args.max_projectiles, pixel_collisions=not args.rect_collisions,
+                        seed=args.seed)
+    if args.serve:
+        serve(args.host, args.port, args.unix, game_options, args.clients, args.steps)
+        return
+    if args.spectate:
+        Spectator((args.host, args.spectator_port)).watch()
+        return
+    if args.broadcast:
+        game_options['broadcast_address'] = (args.host, args.spectator_port)
+    if args.benchmark_snapshots:
+        benchmark_snapshots(Game(**game_options))
+        return
+    if args.benchmark_collisions:
+        benchmark_collisions(Game(**game_options))
+        return
+    if args.benchmark_rendering:
+        benchmark_rendering(Game(**game_options))
+        return
     print('Starting Game')
-    game = Game()
+    game = Game(pipelined=args.pipelined, **game_options)
     game.play()
     print('Game Over')
 